@@ -0,0 +1,205 @@
+"""Checksums of the datasets computed while they are written, stored in a sidecar file next to the NWB file."""
+import json
+import hashlib
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+
+
+def _get_frame_digest(frame: np.ndarray) -> bytes:
+    return hashlib.blake2b(np.ascontiguousarray(frame).tobytes(), digest_size=16).digest()
+
+
+class FrameHasher:
+    def __init__(self, frames_per_block: int = 1024) -> None:
+        """Hash every frame of a video while its chunks are streamed, in whatever order they arrive.
+
+        Parameters
+        ----------
+        frames_per_block : int, default 1024
+            Number of consecutive frame digests combined into one block digest of the sidecar file.
+        """
+        self.frames_per_block = frames_per_block
+        self.frame_shape = None
+        self.dtype = None
+        self._frame_digests = dict()
+
+    def update(self, video: np.ndarray, start_frame: int = 0) -> None:
+        """Hash the frames of a video chunk starting at 'start_frame' that were not hashed yet.
+
+        The frames are hashed as written to the TwoPhotonSeries, i.e. transposed to (columns, rows).
+        """
+        self.frame_shape = [video.shape[2], video.shape[1]]
+        self.dtype = str(video.dtype)
+        for frame_idx, frame in enumerate(video, start=start_frame):
+            if frame_idx not in self._frame_digests:
+                self._frame_digests[frame_idx] = _get_frame_digest(frame.T)
+
+    def get_block_digests(self) -> list:
+        frame_digests = [self._frame_digests[frame_idx] for frame_idx in sorted(self._frame_digests)]
+        return [
+            hashlib.sha256(b"".join(frame_digests[start : start + self.frames_per_block])).hexdigest()
+            for start in range(0, len(frame_digests), self.frames_per_block)
+        ]
+
+    def to_dict(self) -> dict:
+        return dict(
+            kind="frames",
+            num_frames=len(self._frame_digests),
+            frame_shape=self.frame_shape,
+            dtype=self.dtype,
+            frames_per_block=self.frames_per_block,
+            block_digests=self.get_block_digests(),
+        )
+
+
+class DatasetChecksums:
+    """
+    Collect the checksums of the datasets of an NWBFile before it is written.
+
+    Datasets are identified by the object_id of the container that holds them, which is persisted in the file, and
+    the name of the field, e.g. 'data' or 'timestamps'. Containers written as a dataset, e.g. an Image, carry the
+    object_id on the dataset itself and are registered with an empty field. In-memory arrays are hashed as soon as
+    they are registered, videos are hashed frame by frame through a FrameHasher fed by the imaging extractor.
+    """
+
+    def __init__(self) -> None:
+        self.datasets = dict()
+
+    def add_array(self, container, field: str, array) -> None:
+        array = np.asarray(array)
+        self.datasets[f"{container.object_id}/{field}"] = dict(
+            kind="array",
+            name=container.name,
+            shape=list(array.shape),
+            dtype=str(array.dtype),
+            sha256=hashlib.sha256(np.ascontiguousarray(array).tobytes()).hexdigest(),
+        )
+
+    def add_frame_hasher(self, container, field: str, frames_per_block: int = 1024) -> FrameHasher:
+        frame_hasher = FrameHasher(frames_per_block=frames_per_block)
+        self.datasets[f"{container.object_id}/{field}"] = dict(name=container.name, frame_hasher=frame_hasher)
+        return frame_hasher
+
+    def to_dict(self) -> dict:
+        datasets = dict()
+        for dataset_id, checksum in self.datasets.items():
+            frame_hasher = checksum.get("frame_hasher")
+            if frame_hasher is not None:
+                checksum = dict(name=checksum["name"], **frame_hasher.to_dict())
+            datasets[dataset_id] = checksum
+        return dict(datasets=datasets)
+
+    def save(self, checksums_path: Union[str, Path]) -> None:
+        with open(checksums_path, "w") as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+
+def get_checksums_path(nwbfile_path: Union[str, Path]) -> Path:
+    nwbfile_path = Path(nwbfile_path)
+    return nwbfile_path.with_name(f"{nwbfile_path.stem}.checksums.json")
+
+
+def _iter_row_blocks(dataset, block_size: int = None):
+    block_size = block_size or (dataset.chunks[0] if dataset.chunks else 1024)
+    for start in range(0, dataset.shape[0], block_size):
+        yield start, dataset[start : start + block_size]
+
+
+def _verify_array(dataset, checksum: dict) -> list:
+    if list(dataset.shape) != checksum["shape"]:
+        return [f"shape {list(dataset.shape)} differs from source shape {checksum['shape']}"]
+    sha256 = hashlib.sha256()
+    if dataset.ndim == 0:
+        sha256.update(np.ascontiguousarray(dataset[()], dtype=checksum["dtype"]).tobytes())
+    else:
+        for _, block in _iter_row_blocks(dataset):
+            sha256.update(np.ascontiguousarray(block, dtype=checksum["dtype"]).tobytes())
+    if sha256.hexdigest() != checksum["sha256"]:
+        return ["content differs from source"]
+    return []
+
+
+def _verify_frames(dataset, checksum: dict) -> list:
+    if dataset.shape[0] != checksum["num_frames"]:
+        return [f"{dataset.shape[0]} frames written, {checksum['num_frames']} frames read from source"]
+    if list(dataset.shape[1:]) != checksum["frame_shape"]:
+        return [f"frame shape {list(dataset.shape[1:])} differs from source frame shape {checksum['frame_shape']}"]
+    frames_per_block = checksum["frames_per_block"]
+
+    errors = []
+    for start, block in _iter_row_blocks(dataset, block_size=frames_per_block):
+        block = np.asarray(block, dtype=checksum["dtype"])
+        frame_digests = [_get_frame_digest(frame) for frame in block]
+        block_digest = hashlib.sha256(b"".join(frame_digests)).hexdigest()
+        if block_digest != checksum["block_digests"][start // frames_per_block]:
+            errors.append(f"content of frames {start} to {start + len(block)} differs from source")
+    return errors
+
+
+def verify_nwbfile_checksums(nwbfile_path: Union[str, Path], checksums_path: Union[str, Path] = None) -> dict:
+    """
+    Compare the datasets of a written NWB file with the checksums computed from the source data.
+
+    The datasets are read chunk by chunk, the source data is not read again.
+
+    Parameters
+    ----------
+    nwbfile_path : Union[str, Path]
+        The path to the NWB file.
+    checksums_path : Union[str, Path], optional
+        The path to the sidecar file. Defaults to '<nwbfile stem>.checksums.json' next to the NWB file.
+
+    Returns
+    -------
+    dict
+        The list of errors for each dataset that does not match, keyed by '<container name>/<field>', or by the
+        container name for the containers written as a dataset.
+    """
+    import h5py
+
+    checksums_path = checksums_path or get_checksums_path(nwbfile_path)
+    with open(checksums_path) as file:
+        checksums = json.load(file)["datasets"]
+
+    errors = dict()
+    with h5py.File(nwbfile_path, "r") as file:
+        objects_by_object_id = dict()
+
+        def collect_object(name, obj):
+            # Both groups and datasets, e.g. an Image, can hold the object_id of a container
+            object_id = obj.attrs.get("object_id")
+            if object_id is not None:
+                objects_by_object_id[object_id.decode() if isinstance(object_id, bytes) else object_id] = obj
+
+        file.visititems(collect_object)
+
+        for dataset_id, checksum in checksums.items():
+            object_id, field = dataset_id.split("/")
+            obj = objects_by_object_id.get(object_id)
+            if not field:
+                dataset = obj if isinstance(obj, h5py.Dataset) else None
+            else:
+                dataset = obj[field] if isinstance(obj, h5py.Group) and field in obj else None
+            if dataset is None:
+                dataset_errors = ["dataset not found in the NWB file"]
+            elif checksum["kind"] == "frames":
+                dataset_errors = _verify_frames(dataset, checksum)
+            else:
+                dataset_errors = _verify_array(dataset, checksum)
+            if dataset_errors:
+                errors[f"{checksum['name']}/{field}" if field else checksum["name"]] = dataset_errors
+
+    return errors
+
+
+if __name__ == "__main__":
+    import sys
+
+    for nwbfile_path in sys.argv[1:]:
+        errors = verify_nwbfile_checksums(nwbfile_path)
+        for dataset_name, dataset_errors in errors.items():
+            for error in dataset_errors:
+                print(f"{nwbfile_path}: {dataset_name}: {error}")
+        print(f"{nwbfile_path}: {'OK' if not errors else 'FAILED'}")
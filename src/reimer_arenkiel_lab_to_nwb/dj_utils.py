@@ -1,5 +1,7 @@
+import os
 import uuid
 import datetime
+from pathlib import Path
 from copy import deepcopy
 from zoneinfo import ZoneInfo
 
@@ -23,18 +25,93 @@ import datajoint as dj
 from neuroconv.tools.nwb_helpers import configure_and_write_nwbfile
 from tqdm import tqdm
 
-conn = dj.conn()
-conn.set_query_cache()
-
-odor = dj.create_virtual_module("odor", "pipeline_odor")
-stimulus = dj.create_virtual_module("stimulus", "pipeline_stimulus")
-treadmill = dj.create_virtual_module("treadmill", "pipeline_treadmill")
-mice = dj.create_virtual_module("mice", "common_mice")
-meso = dj.create_virtual_module("meso", "pipeline_meso")
-all_sessions = dj.create_virtual_module("all_sessions", "pipeline_experiment")
-
-
-def add_treadmill(nwbfile: NWBFile, key: dict = None, verbose: bool = False) -> None:
+from reimer_arenkiel_lab_to_nwb.checksums import DatasetChecksums
+from reimer_arenkiel_lab_to_nwb.timestamps_utils import get_timing_kwargs
+
+_connection = None
+_connection_pid = None
+
+# The schema introspection queries run while creating the virtual modules are cached in this folder.
+# Call get_connection().purge_query_cache() after the database schemas change.
+default_query_cache_path = Path.home() / ".cache" / "reimer_arenkiel_lab_to_nwb" / "datajoint_query_cache"
+
+
+def get_connection() -> dj.Connection:
+    """Connect to the DataJoint database on first use and reuse the connection within the process"""
+    global _connection, _connection_pid
+
+    if _connection is None or _connection_pid != os.getpid():
+        # A connection inherited from a parent process must not be shared with it
+        _connection = dj.conn(reset=_connection_pid is not None)
+        _connection.set_query_cache()
+        _connection_pid = os.getpid()
+
+    return _connection
+
+
+def _load_heading(table) -> None:
+    # The heading is lazy: its columns, status and keys are only queried when its attributes or status are read
+    heading = table.heading
+    heading.attributes
+    heading.table_status
+
+
+def load_table_headings(module) -> None:
+    """Load the headings of all the tables and part tables of a virtual module.
+
+    DataJoint loads a table heading on first use of the table, the headings are loaded here instead so that their
+    introspection queries run while the query cache is on.
+    """
+    for table in vars(module).values():
+        if not (isinstance(table, type) and issubclass(table, dj.Table)):
+            continue
+        _load_heading(table)
+        for part_table in vars(table).values():
+            if isinstance(part_table, type) and issubclass(part_table, dj.Part):
+                _load_heading(part_table)
+
+
+class LazyVirtualModule:
+    """Stand-in for dj.create_virtual_module that connects and introspects the schema on first attribute access"""
+
+    def __init__(self, module_name: str, schema_name: str):
+        self._module_name = module_name
+        self._schema_name = schema_name
+        self._module = None
+        self._module_pid = None
+
+    def _get_module(self):
+        if self._module is None or self._module_pid != os.getpid():
+            connection = get_connection()
+            if dj.config.get("query_cache") is None:
+                default_query_cache_path.mkdir(parents=True, exist_ok=True)
+                dj.config["query_cache"] = str(default_query_cache_path)
+            connection.set_query_cache(query_cache="schema_introspection")
+            try:
+                self._module = dj.create_virtual_module(self._module_name, self._schema_name, connection=connection)
+                load_table_headings(self._module)
+            finally:
+                connection.set_query_cache()
+            self._module_pid = os.getpid()
+        return self._module
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._get_module(), name)
+
+
+odor = LazyVirtualModule("odor", "pipeline_odor")
+stimulus = LazyVirtualModule("stimulus", "pipeline_stimulus")
+treadmill = LazyVirtualModule("treadmill", "pipeline_treadmill")
+mice = LazyVirtualModule("mice", "common_mice")
+meso = LazyVirtualModule("meso", "pipeline_meso")
+all_sessions = LazyVirtualModule("all_sessions", "pipeline_experiment")
+
+
+def add_treadmill(
+        nwbfile: NWBFile, key: dict = None, verbose: bool = False, checksums: DatasetChecksums = None
+) -> None:
     """Fetch treadmill data and synchronize to odor clock using linear interpolation with extrapolation"""
 
     if verbose:
@@ -70,15 +147,19 @@ def add_treadmill(nwbfile: NWBFile, key: dict = None, verbose: bool = False) ->
     if "behavior" not in nwbfile.processing:
         nwbfile.create_processing_module(name="behavior", description="behavioral data processing")
 
-    nwbfile.processing["behavior"].add(
-        TimeSeries(
-            name="treadmill_velocity",
-            description="treadmill velocity from Treadmill table",
-            data=tread_vel,
-            timestamps=treadmill_raw_spatial_series,
-            unit="unknown",
-        )
+    treadmill_velocity = TimeSeries(
+        name="treadmill_velocity",
+        description="treadmill velocity from Treadmill table",
+        data=tread_vel,
+        timestamps=treadmill_raw_spatial_series,
+        unit="unknown",
     )
+    nwbfile.processing["behavior"].add(treadmill_velocity)
+
+    if checksums is not None:
+        checksums.add_array(treadmill_raw_spatial_series, "data", tread_raw)
+        checksums.add_array(treadmill_raw_spatial_series, "timestamps", odor_tread_times)
+        checksums.add_array(treadmill_velocity, "data", tread_vel)
 
 
 def add_subject(nwbfile: NWBFile, key: dict = None, verbose: bool = False) -> None:
@@ -117,7 +198,7 @@ def add_odor_trials(nwbfile: NWBFile, key: dict = None, verbose: bool = False) -
         )
 
 
-def add_respiration(nwbfile: NWBFile, key=None, verbose: bool = False):
+def add_respiration(nwbfile: NWBFile, key=None, verbose: bool = False, checksums: DatasetChecksums = None):
     """Fetch respiration data and add to NWBFile"""
 
     if verbose:
@@ -140,8 +221,14 @@ def add_respiration(nwbfile: NWBFile, key=None, verbose: bool = False):
 
     nwbfile.add_acquisition(respiration_signal)
 
+    if checksums is not None:
+        checksums.add_array(respiration_signal, "data", resp_trace)
+        checksums.add_array(respiration_signal, "timestamps", resp_times)
+
 
-def add_summary_images(nwbfile: NWBFile, key: dict = None, verbose: bool = False):
+def add_summary_images(
+        nwbfile: NWBFile, key: dict = None, verbose: bool = False, checksums: DatasetChecksums = None
+):
     """Fetch summary images data and add to NWBFile"""
 
     if verbose:
@@ -172,6 +259,11 @@ def add_summary_images(nwbfile: NWBFile, key: dict = None, verbose: bool = False
 
     nwbfile.processing["ophys"].add(Images(name="correlation_images", images=corr_images, description="Correlation image from SummaryImages.Correlation table."))
 
+    if checksums is not None:
+        # An Image is written as a dataset that holds the object_id itself
+        for image in avg_images + corr_images:
+            checksums.add_array(image, "", image.data)
+
 
 default_ophys_metadata = dict(
     NWBFile=dict(
@@ -261,8 +353,15 @@ def add_plane_segmentation(
     return ps
 
 
-def add_fluorescence(nwbfile, plane_segmentation, key: dict = None, verbose: bool = False) -> None:
-    """Fetch fluorescence trace and add to NWBFile"""
+def add_fluorescence(
+        nwbfile, plane_segmentation, key: dict = None, verbose: bool = False, checksums: DatasetChecksums = None,
+        imaging_rate: float = None,
+) -> RoiResponseSeries:
+    """Fetch fluorescence trace and add to NWBFile
+
+    When the rate of the regular imaging clock is given, the frame times are stored as starting_time and rate,
+    otherwise the timestamps are linked to a series of the NWBFile with the same frame times when there is one.
+    """
 
     if verbose:
         print(f"Adding fluorescence trace for {key}")
@@ -286,13 +385,16 @@ def add_fluorescence(nwbfile, plane_segmentation, key: dict = None, verbose: boo
 
     rt_region = plane_segmentation.create_roi_table_region(region=slice(None), description="all ROIs")
 
+    fluorescence_timestamps = odor_scan_times[:len(fluorescence_trace)]
+    timing_kwargs = get_timing_kwargs(nwbfile, timestamps=fluorescence_timestamps, rate=imaging_rate)
+
     roi_response_series = RoiResponseSeries(
         name=f"fluorescence_FOV{field}_channel{channel}",
         description=f"Fluorescence traces from FOV{field} Channel{channel}",
         data=fluorescence_trace,
         unit="n.a.",
-        timestamps=odor_scan_times[:len(fluorescence_trace)],
         rois=rt_region,
+        **timing_kwargs,
     )
 
     if f"fluorescence" not in nwbfile.processing["ophys"].data_interfaces:
@@ -302,11 +404,21 @@ def add_fluorescence(nwbfile, plane_segmentation, key: dict = None, verbose: boo
         fluoresence = nwbfile.processing["ophys"].data_interfaces[f"fluorescence"]
     fluoresence.add_roi_response_series(roi_response_series)
 
-def get_imaging_start_time(key: dict = None):
+    if checksums is not None:
+        checksums.add_array(roi_response_series, "data", fluorescence_trace)
+        if isinstance(timing_kwargs.get("timestamps"), np.ndarray):
+            checksums.add_array(roi_response_series, "timestamps", fluorescence_timestamps)
+
+    return roi_response_series
+
+def get_imaging_timestamps(key: dict = None):
     restriction = (
             odor.MesoMatch & key
     )  # Since tables can be restrictions, saving this shorthand simplifies following code
-    odor_scan_times = (odor.OdorSync & restriction).fetch1("frame_times")
+    return (odor.OdorSync & restriction).fetch1("frame_times")
+
+def get_imaging_start_time(key: dict = None):
+    odor_scan_times = get_imaging_timestamps(key=key)
     return odor_scan_times[0]
 
 def init_nwbfile(key: dict, metadata: dict = None) -> NWBFile:
@@ -358,10 +470,17 @@ def get_ophys_keys(key: dict):
     return [ophys_key for ophys_key in meso.Segmentation() & key]
 
 
+def get_num_frames(key: dict):
+    return (meso.ScanInfo & key).fetch1("nframes")
+
+
+def get_num_rois(key: dict):
+    return len(meso.Fluorescence.Trace & key)
+
+
 if __name__ == "__main__":
     verbose = True
-    conn = dj.conn()
-    conn.set_query_cache()
+    get_connection()
     keys = [key for key in odor.MesoMatch()]
 
     for key in tqdm(keys, desc="Processing sessions"):
@@ -1,17 +1,69 @@
+import time
+import warnings
 from pathlib import Path
+from typing import Optional
 from neuroconv.utils import FilePathType, FolderPathType
 from nwbinspector import inspect_all
 from nwbinspector.inspector_tools import save_report, format_messages
 from tqdm import tqdm
 from embargo2024_convert_session import session_to_nwb
-import datajoint as dj
+from embargo2024_session_queue import SessionWorkQueue
+from embargo2024_plan_sessions import get_session_size, load_plan_keys, record_profiling_run
+
+from reimer_arenkiel_lab_to_nwb.dj_utils import get_connection, get_session_keys
+
+
+def get_peak_memory() -> Optional[float]:
+    """Return the peak resident memory of the process in bytes, or None where it cannot be measured."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    import sys
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return float(max_rss if sys.platform == "darwin" else max_rss * 1024)
+
+
+def convert_and_profile_session(data_dir_path: FilePathType, output_dir_path: Path, key: dict, stub_test: bool):
+    """Convert a session and record its runtime and peak memory to calibrate the conversion plans."""
+    start_time = time.perf_counter()
+    peak_memory_before = get_peak_memory()
+    session_to_nwb(
+        data_dir_path=data_dir_path,
+        output_dir_path=output_dir_path,
+        key=key,
+        stub_test=stub_test,
+    )
+    if stub_test:
+        return
+    seconds = time.perf_counter() - start_time
+    # The peak memory of the process never decreases, it is the peak of this session only if it rose during it
+    peak_memory = get_peak_memory()
+    if peak_memory is not None and peak_memory_before is not None and peak_memory <= peak_memory_before:
+        peak_memory = None
+    # The session is converted at this point, failing to profile it must not fail the conversion
+    try:
+        record_profiling_run(
+            profiling_dir_path=output_dir_path / "conversion_profiling",
+            key=key,
+            session_size=get_session_size(data_dir_path=data_dir_path, key=key),
+            seconds=seconds,
+            peak_memory=peak_memory,
+        )
+    except Exception as error:
+        warnings.warn(f"Could not record the profiling run of {key}: {error}")
 
-from reimer_arenkiel_lab_to_nwb.dj_utils import get_session_keys
 
 def convert_all_sessions(
     data_dir_path: FilePathType,
     output_dir_path: FolderPathType,
     stub_test: bool = False,
+    distributed: bool = False,
+    lease_timeout: float = 600.0,
+    heartbeat_interval: float = 60.0,
+    plan_path: Optional[FilePathType] = None,
+    worker_index: Optional[int] = None,
 ):
     """
     Convert all sessions from the Vu 2024 dataset to NWB format.
@@ -26,18 +78,67 @@ def convert_all_sessions(
         Whether to run the conversion as a stub test.
         When set to True, write only a subset of the data for each session.
         When set to False, write the entire data for each session.
+    distributed : bool, optional
+        Whether to share the sessions with other nodes running the same command on the same output folder.
+        When set to True, each session is claimed through a lease file in a '.session_queue' folder next to the NWB
+        files ('output_dir_path/nwb_stub' for a stub test) and sessions claimed by nodes that stopped renewing their
+        lease are reclaimed.
+    lease_timeout : float, optional
+        Number of seconds without heartbeat after which the lease of a session is reclaimed. Only used if distributed.
+    heartbeat_interval : float, optional
+        Number of seconds between two renewals of the lease of a session. Only used if distributed.
+    plan_path : FilePathType, optional
+        The path to a plan saved by embargo2024_plan_sessions. When provided, the sessions are converted largest
+        first instead of in database order.
+    worker_index : int, optional
+        The index of this worker in the plan. When provided, only the sessions assigned to this worker are converted.
 
     """
 
-    keys = get_session_keys()
-    for key in tqdm(keys, desc="Processing sessions"):
-        dj.conn()
-        session_to_nwb(
-            data_dir_path=data_dir_path,
-            output_dir_path=output_dir_path,
-            key=key,
-            stub_test=stub_test,
+    output_dir_path = Path(output_dir_path)
+    keys = get_session_keys() if plan_path is None else load_plan_keys(plan_path=plan_path, worker_index=worker_index)
+    if not distributed:
+        for key in tqdm(keys, desc="Processing sessions"):
+            get_connection()
+            convert_and_profile_session(
+                data_dir_path=data_dir_path, output_dir_path=output_dir_path, key=key, stub_test=stub_test
+            )
+    else:
+        # The stub files are written to a subfolder, the queue is kept next to the files actually written so that
+        # the sessions finished by a stub run are not skipped by a later full run
+        nwb_dir_path = output_dir_path / "nwb_stub" if stub_test else output_dir_path
+        session_queue = SessionWorkQueue(
+            queue_dir_path=nwb_dir_path / ".session_queue",
+            lease_timeout=lease_timeout,
+            heartbeat_interval=heartbeat_interval,
         )
+        # Sessions held by other nodes are polled again until they are finished, so that the leases of nodes that
+        # died are reclaimed by the surviving ones
+        progress_bar = tqdm(total=len(keys), desc="Processing sessions")
+        pending_keys = keys
+        while True:
+            for key in pending_keys:
+                if not session_queue.claim(key):
+                    continue
+                try:
+                    with session_queue.heartbeat(key):
+                        get_connection()
+                        convert_and_profile_session(
+                            data_dir_path=data_dir_path, output_dir_path=output_dir_path, key=key, stub_test=stub_test
+                        )
+                except Exception as error:
+                    session_queue.mark_failed(key, error=error)
+                    print(f"Conversion failed for {key}: {error}")
+                    continue
+                session_queue.mark_done(key)
+
+            unfinished_keys = [key for key in pending_keys if not session_queue.is_finished(key)]
+            progress_bar.update(len(pending_keys) - len(unfinished_keys))
+            pending_keys = unfinished_keys
+            if not pending_keys:
+                break
+            time.sleep(heartbeat_interval)
+        progress_bar.close()
 
     report_path = output_dir_path / "inspector_result.txt"
     if not report_path.exists():
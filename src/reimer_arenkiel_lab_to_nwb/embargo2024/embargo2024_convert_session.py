@@ -1,12 +1,20 @@
 """Primary script to run to convert an entire session for of data using the NWBConverter."""
 
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 from tqdm import tqdm
+from pynwb import NWBHDF5IO, TimeSeries
 from neuroconv.utils import load_dict_from_file, dict_deep_update
-from neuroconv.tools.nwb_helpers import configure_and_write_nwbfile
+from neuroconv.tools.nwb_helpers import (
+    configure_and_write_nwbfile,
+    configure_backend,
+    HDF5BackendConfiguration,
+    HDF5DatasetIOConfiguration,
+)
 
 from reimer_arenkiel_lab_to_nwb.embargo2024 import Embargo2024NWBConverter
+from reimer_arenkiel_lab_to_nwb.checksums import DatasetChecksums, get_checksums_path
+from reimer_arenkiel_lab_to_nwb.timestamps_utils import get_regular_rate, link_duplicate_timestamps
 from reimer_arenkiel_lab_to_nwb.dj_utils import (
     init_nwbfile,
     add_treadmill,
@@ -15,16 +23,74 @@ from reimer_arenkiel_lab_to_nwb.dj_utils import (
     add_respiration,
     add_summary_images,
     get_ophys_keys,
+    get_imaging_timestamps,
     add_plane_segmentation,
     add_fluorescence,
-    get_session_keys
+    get_session_keys,
+    get_connection,
 )
 
 
+def configure_plane_datasets(nwbfile, plane_segmentation, roi_response_series):
+    """Configure chunking and compression of the datasets of a plane appended to a written file.
+
+    Only the new datasets are configured, the datasets already in the file are not scanned again.
+    """
+    # Every column is configured, e.g. both the pixel_mask data and its pixel_mask_index
+    neurodata_objects_and_dataset_names = [(column, "data") for column in plane_segmentation.columns]
+    neurodata_objects_and_dataset_names.append((plane_segmentation.id, "data"))
+    neurodata_objects_and_dataset_names.append((roi_response_series, "data"))
+    timestamps = roi_response_series.fields.get("timestamps")
+    if timestamps is not None and not isinstance(timestamps, TimeSeries):
+        # The series owns its timestamps rather than linking to another series or storing a rate
+        neurodata_objects_and_dataset_names.append((roi_response_series, "timestamps"))
+
+    dataset_configurations = dict()
+    for neurodata_object, dataset_name in neurodata_objects_and_dataset_names:
+        dataset_configuration = HDF5DatasetIOConfiguration.from_neurodata_object(
+            neurodata_object=neurodata_object, dataset_name=dataset_name
+        )
+        dataset_configurations[dataset_configuration.location_in_file] = dataset_configuration
+
+    backend_configuration = HDF5BackendConfiguration(dataset_configurations=dataset_configurations)
+    configure_backend(nwbfile=nwbfile, backend_configuration=backend_configuration)
+
+
 def session_to_nwb(
         data_dir_path: Union[str, Path], output_dir_path: Union[str, Path], key: dict, stub_test: bool = False,
-        verbose: bool = True
+        verbose: bool = True, preview_levels: Optional[list] = None, write_checksums: bool = False,
+        incremental_write: bool = False, timestamps_tolerance: float = 1e-3,
 ):
+    """
+    Convert a single session to NWB format.
+
+    Parameters
+    ----------
+    data_dir_path : Union[str, Path]
+        The path to all the sessions folders containing the raw imaging data.
+    output_dir_path : Union[str, Path]
+        The folder path to save the NWB file.
+    key : dict
+        The DataJoint key of the session.
+    stub_test : bool, optional
+        Whether to write only a subset of the data.
+    verbose : bool, optional
+        Whether to print progress messages.
+    preview_levels : list of (int, int), optional
+        Pairs of (temporal_bin_size, spatial_downsampling_factor). When provided, a binned and downsampled preview of
+        each FOV/channel is computed while the raw frames are written and stored next to the raw TwoPhotonSeries.
+    write_checksums : bool, optional
+        Whether to compute checksums of the datasets while the data is written and save them to a
+        '<nwbfile stem>.checksums.json' sidecar file. The file can then be checked with
+        reimer_arenkiel_lab_to_nwb.checksums.verify_nwbfile_checksums.
+    incremental_write : bool, optional
+        Whether to write the file without the segmentation and fluorescence first, then append them one imaging
+        plane at a time. The memory used to build the file is then bounded by the size of a single plane instead of
+        the size of the whole session.
+    timestamps_tolerance : float, optional
+        The maximum deviation in seconds from a regular grid for frame times to be stored as starting_time and rate.
+        Irregular frame times shared by several series are stored once and linked from the other series.
+    """
     data_dir_path = Path(data_dir_path)
     folder_path = data_dir_path / f"{key['animal_id']}_{key['session']}_{key['scan_idx']}"
     if not folder_path.is_dir():
@@ -66,12 +132,15 @@ def session_to_nwb(
             "stub_test": stub_test,
             "photon_series_index": photon_series_index,
             "photon_series_type": "TwoPhotonSeries",
+            "preview_levels": preview_levels,
         }
         photon_series_index += 1
 
     converter = Embargo2024NWBConverter(source_data=source_data)
 
-    converter.temporally_align_data_interfaces(key=key)
+    # The same rule decides for the imaging and the fluorescence whether the frame clock is stored as a rate
+    imaging_rate = get_regular_rate(get_imaging_timestamps(key=key), tolerance=timestamps_tolerance)
+    converter.temporally_align_data_interfaces(key=key, imaging_rate=imaging_rate)
 
     # Add datetime to conversion
     metadata = converter.get_metadata()
@@ -90,31 +159,81 @@ def session_to_nwb(
         metadata=metadata, nwbfile=nwbfile, conversion_options=conversion_options
     )
 
-    add_treadmill(nwbfile, key=key, verbose=verbose)
+    # All FOVs and channels are acquired with the same frame clock, their timestamps are stored only once
+    photon_series_names = [photon_series["name"] for photon_series in metadata["Ophys"]["TwoPhotonSeries"]]
+    photon_series = [nwbfile.acquisition[name] for name in photon_series_names if name in nwbfile.acquisition]
+    link_duplicate_timestamps(photon_series)
+    del photon_series
+
+    checksums = DatasetChecksums() if write_checksums else None
+    if write_checksums:
+        # The raw frames are hashed by the extractors while they are streamed to the file
+        for interface_name, interface in converter.data_interface_objects.items():
+            photon_series_index = conversion_options[interface_name]["photon_series_index"]
+            photon_series_name = metadata["Ophys"]["TwoPhotonSeries"][photon_series_index]["name"]
+            frame_hasher = checksums.add_frame_hasher(nwbfile.acquisition[photon_series_name], "data")
+            interface.imaging_extractor.add_video_observer(frame_hasher)
+
+    add_treadmill(nwbfile, key=key, verbose=verbose, checksums=checksums)
     add_subject(nwbfile, key=key, verbose=verbose)
     add_odor_trials(nwbfile, key=key, verbose=verbose)
-    add_respiration(nwbfile, key=key, verbose=verbose)
-    add_summary_images(nwbfile, key=key, verbose=verbose)
+    add_respiration(nwbfile, key=key, verbose=verbose, checksums=checksums)
+    add_summary_images(nwbfile, key=key, verbose=verbose, checksums=checksums)
 
-    for ophys_key in tqdm(ophys_keys, desc="Processing imaging planes"):
-        if ophys_key['channel']==1:
+    segmented_ophys_keys = [ophys_key for ophys_key in ophys_keys if ophys_key['channel']==1]
+    if not incremental_write:
+        for ophys_key in tqdm(segmented_ophys_keys, desc="Processing imaging planes"):
             imaging_plane = nwbfile.imaging_planes["imaging_plane_channel1"]
             plane_segmentation = add_plane_segmentation(nwbfile, imaging_plane, key=ophys_key, verbose=verbose)
-            add_fluorescence(nwbfile, plane_segmentation, key=ophys_key, verbose=verbose)
+            add_fluorescence(
+                nwbfile, plane_segmentation, key=ophys_key, verbose=verbose, checksums=checksums,
+                imaging_rate=imaging_rate,
+            )
 
     if verbose:
         print("Write NWB file")
     configure_and_write_nwbfile(nwbfile=nwbfile, backend="hdf5", output_filepath=nwbfile_path)
 
+    if incremental_write:
+        del nwbfile
+        # Each plane is appended and flushed to disk, then released before the next one is fetched
+        for ophys_key in tqdm(segmented_ophys_keys, desc="Processing imaging planes"):
+            with NWBHDF5IO(nwbfile_path, mode="a") as io:
+                nwbfile = io.read()
+                imaging_plane = nwbfile.imaging_planes["imaging_plane_channel1"]
+                plane_segmentation = add_plane_segmentation(nwbfile, imaging_plane, key=ophys_key, verbose=verbose)
+                roi_response_series = add_fluorescence(
+                    nwbfile, plane_segmentation, key=ophys_key, verbose=verbose, checksums=checksums,
+                    imaging_rate=imaging_rate,
+                )
+                configure_plane_datasets(
+                    nwbfile=nwbfile, plane_segmentation=plane_segmentation, roi_response_series=roi_response_series
+                )
+                io.write(nwbfile)
+            del nwbfile, imaging_plane, plane_segmentation, roi_response_series
+
+    if write_checksums:
+        checksums.save(get_checksums_path(nwbfile_path))
+
+    if preview_levels:
+        if verbose:
+            print("Add imaging previews to NWB file")
+        # The previews were accumulated while the raw frames were written, so the TIFF files are not read again
+        with NWBHDF5IO(nwbfile_path, mode="a") as io:
+            nwbfile = io.read()
+            for interface_name, interface in converter.data_interface_objects.items():
+                photon_series_index = conversion_options[interface_name]["photon_series_index"]
+                photon_series_name = metadata["Ophys"]["TwoPhotonSeries"][photon_series_index]["name"]
+                interface.add_previews_to_nwbfile(nwbfile=nwbfile, photon_series_name=photon_series_name)
+            io.write(nwbfile)
 
-if __name__ == "__main__":
-    import datajoint as dj
 
+if __name__ == "__main__":
     root_path = Path("F:/CN_data")
     data_dir_path = root_path / "Reimer-Arenkiel-CN-data-share"
     output_dir_path = root_path / "Reimer-Arenkiel-conversion_nwb/"
     stub_test = True
-    dj.conn()
+    get_connection()
     keys = get_session_keys()
     session_to_nwb(
         data_dir_path=data_dir_path,
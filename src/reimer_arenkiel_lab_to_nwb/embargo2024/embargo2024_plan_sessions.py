@@ -0,0 +1,224 @@
+"""Estimate the cost of converting each session and schedule the sessions on the conversion workers."""
+import json
+import warnings
+import statistics
+from pathlib import Path
+from typing import List, Optional, Union
+
+from embargo2024_session_queue import SessionWorkQueue
+
+from reimer_arenkiel_lab_to_nwb.dj_utils import get_num_frames, get_num_rois, get_session_keys
+
+# Used when there is no past profiling run to calibrate the cost model
+default_throughput = 100e6  # bytes written per second
+default_base_memory = 2e9  # bytes used by a conversion independently of the session size
+default_memory_factor = 3.0  # bytes of memory used per byte of data held in memory before writing
+
+
+def _to_json_key(key: dict) -> dict:
+    # The keys fetched from DataJoint hold numpy scalars
+    return {name: value.item() if hasattr(value, "item") else value for name, value in key.items()}
+
+
+def get_session_size(data_dir_path: Union[str, Path], key: dict) -> dict:
+    """
+    Measure the size of a session from the TIFF file sizes and the frame and ROI counts in the database.
+
+    Nothing is read from the TIFF files and no trace is fetched.
+    """
+    folder_path = Path(data_dir_path) / f"{key['animal_id']}_{key['session']}_{key['scan_idx']}"
+    file_pattern = f"{key['animal_id']}_{key['session']}_*.tif"
+    raw_bytes = sum(file_path.stat().st_size for file_path in folder_path.glob(file_pattern))
+
+    num_frames = int(get_num_frames(key=key))
+    num_rois = int(get_num_rois(key=key))
+    # The fluorescence traces of all planes are held in memory until the file is written
+    in_memory_bytes = num_frames * num_rois * 8
+
+    return dict(
+        raw_bytes=raw_bytes,
+        num_frames=num_frames,
+        num_rois=num_rois,
+        in_memory_bytes=in_memory_bytes,
+        total_bytes=raw_bytes + in_memory_bytes,
+    )
+
+
+def load_profiling_runs(profiling_dir_path: Union[str, Path]) -> List[dict]:
+    """Load the profiling runs of a folder, skipping the files left incomplete by an interrupted worker."""
+    profiling_runs = []
+    for profiling_run_path in sorted(Path(profiling_dir_path).glob("*.json")):
+        try:
+            with open(profiling_run_path) as file:
+                profiling_runs.append(json.load(file))
+        except ValueError:
+            continue
+    return profiling_runs
+
+
+def record_profiling_run(
+    profiling_dir_path: Union[str, Path], key: dict, session_size: dict, seconds: float, peak_memory: Optional[float]
+) -> None:
+    """
+    Save the measured runtime and peak memory of a conversion, used to calibrate later plans.
+
+    Each session is saved to its own file, so that the workers sharing the folder never write to the same file.
+    """
+    profiling_dir_path = Path(profiling_dir_path)
+    profiling_dir_path.mkdir(parents=True, exist_ok=True)
+    profiling_run = dict(key=_to_json_key(key), seconds=seconds, peak_memory=peak_memory, **session_size)
+    with open(profiling_dir_path / f"{SessionWorkQueue.get_session_name(key)}.json", "w") as file:
+        json.dump(profiling_run, file)
+
+
+def calibrate_cost_model(profiling_runs: List[dict]) -> dict:
+    """Fit the throughput and the memory model to past profiling runs, falling back on the defaults."""
+    throughput = default_throughput
+    memory_factor = default_memory_factor
+
+    timed_runs = [run for run in profiling_runs if run.get("seconds")]
+    if timed_runs:
+        throughput = sum(run["total_bytes"] for run in timed_runs) / sum(run["seconds"] for run in timed_runs)
+
+    memory_runs = [run for run in profiling_runs if run.get("peak_memory") and run.get("in_memory_bytes")]
+    if memory_runs:
+        # The median is robust to the few runs whose peak memory is dominated by something else than the traces
+        memory_factor = statistics.median(
+            (run["peak_memory"] - default_base_memory) / run["in_memory_bytes"] for run in memory_runs
+        )
+        memory_factor = max(memory_factor, 1.0)
+
+    return dict(throughput=throughput, base_memory=default_base_memory, memory_factor=memory_factor)
+
+
+def estimate_session_cost(session_size: dict, cost_model: dict) -> dict:
+    estimated_seconds = session_size["total_bytes"] / cost_model["throughput"]
+    estimated_peak_memory = cost_model["base_memory"] + cost_model["memory_factor"] * session_size["in_memory_bytes"]
+    return dict(estimated_seconds=estimated_seconds, estimated_peak_memory=estimated_peak_memory)
+
+
+def plan_sessions(
+    data_dir_path: Union[str, Path],
+    worker_memory_limits: List[float],
+    keys: Optional[List[dict]] = None,
+    profiling_dir_path: Optional[Union[str, Path]] = None,
+) -> dict:
+    """
+    Estimate the cost of each session and assign the sessions to the workers, largest first.
+
+    Each session goes to the worker with the least estimated work among the workers whose memory limit fits the
+    estimated peak memory of the session. Sessions that do not fit on any worker are listed as unschedulable.
+
+    Parameters
+    ----------
+    data_dir_path : Union[str, Path]
+        The path to all the sessions folders containing the raw imaging data.
+    worker_memory_limits : list of float
+        The memory limit in bytes of each worker. A worker converts one session at a time.
+    keys : list of dict, optional
+        The sessions to plan. Defaults to all the sessions.
+    profiling_dir_path : Union[str, Path], optional
+        The folder of the profiling runs recorded by convert_all_sessions, used to calibrate the cost model.
+
+    Returns
+    -------
+    dict
+        The plan, with the sessions of each worker in conversion order and the estimated totals.
+    """
+    keys = keys if keys is not None else get_session_keys()
+    profiling_runs = load_profiling_runs(profiling_dir_path) if profiling_dir_path is not None else []
+    cost_model = calibrate_cost_model(profiling_runs)
+
+    sessions = []
+    for key in keys:
+        session_size = get_session_size(data_dir_path=data_dir_path, key=key)
+        session_cost = estimate_session_cost(session_size=session_size, cost_model=cost_model)
+        session_name = SessionWorkQueue.get_session_name(key)
+        sessions.append(dict(key=_to_json_key(key), name=session_name, **session_size, **session_cost))
+    sessions.sort(key=lambda session: session["estimated_seconds"], reverse=True)
+
+    workers = [
+        dict(memory_limit=memory_limit, estimated_seconds=0.0, estimated_peak_memory=0.0, sessions=[])
+        for memory_limit in worker_memory_limits
+    ]
+    unschedulable_sessions = []
+    for session in sessions:
+        fitting_workers = [worker for worker in workers if session["estimated_peak_memory"] <= worker["memory_limit"]]
+        if not fitting_workers:
+            unschedulable_sessions.append(session)
+            continue
+        worker = min(fitting_workers, key=lambda worker: worker["estimated_seconds"])
+        worker["sessions"].append(session)
+        worker["estimated_seconds"] += session["estimated_seconds"]
+        worker["estimated_peak_memory"] = max(worker["estimated_peak_memory"], session["estimated_peak_memory"])
+
+    return dict(
+        cost_model=cost_model,
+        workers=workers,
+        unschedulable_sessions=unschedulable_sessions,
+        estimated_total_seconds=max((worker["estimated_seconds"] for worker in workers), default=0.0),
+        estimated_peak_memory=max((worker["estimated_peak_memory"] for worker in workers), default=0.0),
+    )
+
+
+def save_plan(plan: dict, plan_path: Union[str, Path]) -> None:
+    with open(plan_path, "w") as file:
+        json.dump(plan, file, indent=2)
+
+
+def load_plan_keys(plan_path: Union[str, Path], worker_index: Optional[int] = None) -> List[dict]:
+    """
+    Return the session keys of a worker in conversion order, or of all the sessions largest first.
+
+    The sessions that do not fit on any worker are only converted when all the sessions are requested, after all the
+    others, as they may run out of memory.
+    """
+    with open(plan_path) as file:
+        plan = json.load(file)
+
+    if worker_index is not None:
+        return [session["key"] for session in plan["workers"][worker_index]["sessions"]]
+
+    sessions = [session for worker in plan["workers"] for session in worker["sessions"]]
+    sessions.sort(key=lambda session: session["estimated_seconds"], reverse=True)
+    for session in plan["unschedulable_sessions"]:
+        warnings.warn(
+            f"{session['name']} does not fit on any worker of the plan, it is converted last "
+            f"with an estimated peak memory of {session['estimated_peak_memory'] / 1e9:.1f} GB."
+        )
+    return [session["key"] for session in sessions + plan["unschedulable_sessions"]]
+
+
+def print_plan_summary(plan: dict) -> None:
+    for worker_index, worker in enumerate(plan["workers"]):
+        print(
+            f"Worker {worker_index}: {len(worker['sessions'])} sessions, "
+            f"{worker['estimated_seconds'] / 3600:.1f} h, "
+            f"peak memory {worker['estimated_peak_memory'] / 1e9:.1f} GB "
+            f"(limit {worker['memory_limit'] / 1e9:.1f} GB)"
+        )
+    for session in plan["unschedulable_sessions"]:
+        print(
+            f"{session['name']} does not fit on any worker: "
+            f"estimated peak memory {session['estimated_peak_memory'] / 1e9:.1f} GB"
+        )
+    print(f"Estimated total time: {plan['estimated_total_seconds'] / 3600:.1f} h")
+    print(f"Estimated peak memory: {plan['estimated_peak_memory'] / 1e9:.1f} GB")
+
+
+if __name__ == "__main__":
+    # Dry run: estimate and schedule all sessions without converting anything
+    root_path = Path("F:/CN_data")
+    data_dir_path = root_path / "Reimer-Arenkiel-CN-data-share"
+    output_dir_path = root_path / "Reimer-Arenkiel-conversion_nwb/"
+
+    # The memory limit in bytes of each conversion worker
+    worker_memory_limits = [32e9, 32e9, 64e9]
+
+    plan = plan_sessions(
+        data_dir_path=data_dir_path,
+        worker_memory_limits=worker_memory_limits,
+        profiling_dir_path=output_dir_path / "conversion_profiling",
+    )
+    print_plan_summary(plan)
+    save_plan(plan, output_dir_path / "conversion_plan.json")
@@ -0,0 +1,179 @@
+"""Lock-file work queue to share the conversion of all sessions between several nodes."""
+import os
+import json
+import time
+import uuid
+import socket
+import warnings
+import threading
+import traceback
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Union
+
+
+class SessionWorkQueue:
+    """
+    Work queue backed by lease files in a folder shared between all the conversion nodes.
+
+    A worker claims a session by atomically creating '<session>.lock' and keeps the lease alive by touching the file
+    while converting. A lease that was not renewed for more than 'lease_timeout' seconds belongs to a dead worker and
+    can be reclaimed by any other worker. Finished sessions are recorded with '<session>.done' and sessions that
+    raised with '<session>.failed', so they are not picked up again.
+
+    The takeover of a stale lease is not fully atomic on a shared filesystem: if a third worker creates a new lease
+    while a fresh lease renamed by mistake is put back, the session can end up converted by two workers. The worker
+    that lost its lease is warned by its heartbeat and does not record the session as done or failed.
+    """
+
+    def __init__(
+        self, queue_dir_path: Union[str, Path], lease_timeout: float = 600.0, heartbeat_interval: float = 60.0
+    ):
+        """
+        Parameters
+        ----------
+        queue_dir_path : Union[str, Path]
+            The shared folder where the lease files are stored.
+        lease_timeout : float, default 600.0
+            Number of seconds without heartbeat after which a lease is considered abandoned.
+        heartbeat_interval : float, default 60.0
+            Number of seconds between two renewals of a held lease. Must be well below 'lease_timeout'.
+        """
+        if heartbeat_interval >= lease_timeout:
+            raise ValueError("'heartbeat_interval' must be smaller than 'lease_timeout'.")
+
+        self.queue_dir_path = Path(queue_dir_path)
+        self.queue_dir_path.mkdir(parents=True, exist_ok=True)
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+    @staticmethod
+    def get_session_name(key: dict) -> str:
+        # A session can have several scans, each scan is converted on its own
+        return f"sub-{key['animal_id']}_ses-{key['session']}_scan-{key['scan_idx']}"
+
+    def _get_path(self, key: dict, suffix: str) -> Path:
+        return self.queue_dir_path / f"{self.get_session_name(key)}.{suffix}"
+
+    def is_finished(self, key: dict) -> bool:
+        return self._get_path(key, "done").exists() or self._get_path(key, "failed").exists()
+
+    def claim(self, key: dict) -> bool:
+        """Try to take the lease of a session. Return True if this worker now owns it."""
+        if self.is_finished(key):
+            return False
+
+        lock_path = self._get_path(key, "lock")
+        if self._create_lock(lock_path):
+            return True
+
+        try:
+            lease = self._read_lock(lock_path)
+        except FileNotFoundError:
+            # The owner released the lease in the meantime
+            return not self.is_finished(key) and self._create_lock(lock_path)
+        if not self._is_stale(lease):
+            return False
+
+        # Only one worker can rename the stale lock, the others get FileNotFoundError and move on
+        stale_lock_path = lock_path.with_name(f"{lock_path.name}.stale-{self.worker_id}")
+        try:
+            os.rename(lock_path, stale_lock_path)
+        except FileNotFoundError:
+            return False
+
+        # Another worker may have reclaimed the lease between the check and the rename, in which case the renamed
+        # lock is its fresh lease and is put back
+        try:
+            renamed_lease = self._read_lock(stale_lock_path)
+        except FileNotFoundError:
+            return False
+        if not self._is_stale(renamed_lease) or renamed_lease["content"] != lease["content"]:
+            try:
+                os.link(stale_lock_path, lock_path)
+            except FileExistsError:
+                # A third worker created a new lease in the meantime, the worker of the renamed lease loses it
+                pass
+            stale_lock_path.unlink(missing_ok=True)
+            return False
+
+        stale_lock_path.unlink(missing_ok=True)
+        return self._create_lock(lock_path)
+
+    @staticmethod
+    def _read_lock(lock_path: Path) -> dict:
+        modification_time = lock_path.stat().st_mtime
+        with open(lock_path) as file:
+            content = file.read()
+        return dict(modification_time=modification_time, content=content)
+
+    def _is_stale(self, lease: dict) -> bool:
+        return time.time() - lease["modification_time"] >= self.lease_timeout
+
+    def _create_lock(self, lock_path: Path) -> bool:
+        try:
+            file_descriptor = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(file_descriptor, "w") as file:
+            json.dump(dict(worker_id=self.worker_id, claimed_at=time.time()), file)
+        return True
+
+    def owns(self, key: dict) -> bool:
+        try:
+            with open(self._get_path(key, "lock")) as file:
+                return json.load(file).get("worker_id") == self.worker_id
+        except (FileNotFoundError, ValueError):
+            return False
+
+    @contextmanager
+    def heartbeat(self, key: dict):
+        """Renew the lease of a claimed session in a background thread while the body runs."""
+        lock_path = self._get_path(key, "lock")
+        stop_event = threading.Event()
+
+        def renew_lease():
+            while not stop_event.wait(self.heartbeat_interval):
+                # Never renew the lease of another worker that reclaimed the session
+                if not self.owns(key):
+                    warnings.warn(f"Lost the lease of {self.get_session_name(key)} to another worker.")
+                    return
+                try:
+                    os.utime(lock_path)
+                except FileNotFoundError:
+                    warnings.warn(f"Lost the lease of {self.get_session_name(key)} to another worker.")
+                    return
+
+        heartbeat_thread = threading.Thread(target=renew_lease, daemon=True)
+        heartbeat_thread.start()
+        try:
+            yield
+        finally:
+            stop_event.set()
+            heartbeat_thread.join()
+
+    def mark_done(self, key: dict) -> bool:
+        """Record the session as done, unless the lease was lost to another worker. Return True if recorded."""
+        if not self.owns(key):
+            warnings.warn(f"{self.get_session_name(key)} is not recorded as done, its lease is held by another worker.")
+            return False
+        self._get_path(key, "done").write_text(self.worker_id)
+        self.release(key)
+        return True
+
+    def mark_failed(self, key: dict, error: BaseException) -> bool:
+        """Record the session as failed, unless the lease was lost to another worker. Return True if recorded."""
+        if not self.owns(key):
+            warnings.warn(
+                f"{self.get_session_name(key)} is not recorded as failed, its lease is held by another worker."
+            )
+            return False
+        message = "".join(traceback.format_exception(type(error), error, error.__traceback__))
+        self._get_path(key, "failed").write_text(f"{self.worker_id}\n{message}")
+        self.release(key)
+        return True
+
+    def release(self, key: dict):
+        if self.owns(key):
+            self._get_path(key, "lock").unlink(missing_ok=True)
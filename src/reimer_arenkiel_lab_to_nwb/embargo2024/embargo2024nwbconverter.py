@@ -1,7 +1,8 @@
 """Primary NWBConverter class for this dataset."""
+import numpy as np
 from neuroconv import NWBConverter
 from .interfaces.embargo2024_imaging_interface import Embargo2024ImagingInterface
-from reimer_arenkiel_lab_to_nwb.dj_utils import get_imaging_start_time, get_ophys_keys
+from reimer_arenkiel_lab_to_nwb.dj_utils import get_imaging_timestamps, get_ophys_keys
 
 class Embargo2024NWBConverter(NWBConverter):
     """Primary conversion class for my extracellular electrophysiology dataset."""
@@ -15,9 +16,21 @@ class Embargo2024NWBConverter(NWBConverter):
         ImagingFOV3Channel2=Embargo2024ImagingInterface,
     )
 
-    def temporally_align_data_interfaces(self, key: dict = None):
+    def temporally_align_data_interfaces(self, key: dict = None, imaging_rate: float = None):
+        """Align the imaging to the odor clock.
+
+        When the rate of the regular imaging clock is given, the frames are aligned to a regular grid at that rate so
+        that the series are written with starting_time and rate. Otherwise, the frame times are used as timestamps.
+        """
         ophys_keys = get_ophys_keys(key=key)
         for ophys_key in ophys_keys:
-            imaging_start_time = get_imaging_start_time(key=ophys_key)
+            imaging_timestamps = get_imaging_timestamps(key=ophys_key)
             imaging_interface = self.data_interface_objects[f"ImagingFOV{ophys_key['field']}Channel{ophys_key['channel']}"]
-            imaging_interface.set_aligned_starting_time(imaging_start_time)
+            num_frames = imaging_interface.imaging_extractor.get_num_frames()
+            if imaging_rate is not None:
+                regular_timestamps = imaging_timestamps[0] + np.arange(num_frames) / imaging_rate
+                imaging_interface.set_aligned_timestamps(regular_timestamps)
+            elif len(imaging_timestamps) >= num_frames:
+                imaging_interface.set_aligned_timestamps(imaging_timestamps[:num_frames])
+            else:
+                imaging_interface.set_aligned_starting_time(imaging_timestamps[0])
@@ -1 +1 @@
-from .embargo2024_imaging_extractor import Embargo2024ImagingExtractor
+from .embargo2024_imaging_extractor import Embargo2024ImagingExtractor, PreviewAccumulator
@@ -7,6 +7,57 @@ from roiextractors.imagingextractor import ImagingExtractor
 from roiextractors.extraction_tools import PathType, DtypeType, ArrayType
 
 
+class PreviewAccumulator:
+    def __init__(self, num_frames: int, temporal_bin_size: int = 10, spatial_downsampling_factor: int = 4) -> None:
+        """Accumulate a temporally binned and spatially downsampled copy of a video while its frames are streamed.
+
+        Parameters
+        ----------
+        num_frames : int
+            Total number of frames of the video.
+        temporal_bin_size : int, default 10
+            Number of consecutive frames averaged into one preview frame.
+        spatial_downsampling_factor : int, default 4
+            Side of the square pixel blocks averaged into one preview pixel.
+        """
+        self.temporal_bin_size = temporal_bin_size
+        self.spatial_downsampling_factor = spatial_downsampling_factor
+        self._seen_frames = np.zeros(num_frames, dtype=bool)
+        self._counts = np.zeros(int(np.ceil(num_frames / temporal_bin_size)), dtype="int64")
+        self._sums = None
+
+    def update(self, video: np.ndarray, start_frame: int = 0) -> None:
+        """Add the frames of a video chunk starting at 'start_frame' that were not accumulated yet."""
+        frame_idxs = np.arange(start_frame, start_frame + video.shape[0])
+        is_new = ~self._seen_frames[frame_idxs]
+        if not np.any(is_new):
+            return
+        self._seen_frames[frame_idxs[is_new]] = True
+
+        factor = self.spatial_downsampling_factor
+        n_rows, n_columns = video.shape[1] // factor, video.shape[2] // factor
+        frames = video[is_new, : n_rows * factor, : n_columns * factor].astype("float32")
+
+        # The frame indices are increasing, so the frames of each bin are contiguous and summed in a single pass
+        bin_idxs = frame_idxs[is_new] // self.temporal_bin_size
+        chunk_bin_idxs, bin_starts = np.unique(bin_idxs, return_index=True)
+        bin_sums = np.add.reduceat(frames, bin_starts, axis=0)
+        bin_sums = bin_sums.reshape(len(bin_sums), n_rows, factor, n_columns, factor).mean(axis=(2, 4))
+
+        if self._sums is None:
+            self._sums = np.zeros((len(self._counts), n_rows, n_columns), dtype="float32")
+        self._sums[chunk_bin_idxs] += bin_sums
+        self._counts += np.bincount(bin_idxs, minlength=len(self._counts))
+
+    def get_preview(self) -> np.ndarray:
+        """Return the averaged preview frames, up to the last bin that received any frame."""
+        if self._sums is None:
+            return np.zeros((0, 0, 0), dtype="float32")
+        num_bins = np.flatnonzero(self._counts)[-1] + 1
+        counts = np.maximum(self._counts[:num_bins], 1)
+        return self._sums[:num_bins] / counts[:, np.newaxis, np.newaxis]
+
+
 class Embargo2024ImagingExtractor(ImagingExtractor):
     def __init__(
         self,
@@ -48,13 +99,33 @@ class Embargo2024ImagingExtractor(ImagingExtractor):
         fov_length = self.imaging_extractor.get_image_size()[0] // number_of_fields
         boundaries = [[i * fov_length, (i + 1) * fov_length if i < number_of_fields - 1 else -1] for i in range(number_of_fields)]
         self.fov_boundaries = boundaries[field-1]
+        self.preview_accumulators = []
+        self.video_observers = []
+
+    def add_video_observer(self, video_observer) -> None:
+        """Attach an object whose update(video, start_frame) method is called with every video read by get_video."""
+        self.video_observers.append(video_observer)
+
+    def add_preview_accumulator(self, temporal_bin_size: int, spatial_downsampling_factor: int) -> PreviewAccumulator:
+        """Attach a PreviewAccumulator that is fed with every frame read through get_video."""
+        preview_accumulator = PreviewAccumulator(
+            num_frames=self.get_num_frames(),
+            temporal_bin_size=temporal_bin_size,
+            spatial_downsampling_factor=spatial_downsampling_factor,
+        )
+        self.preview_accumulators.append(preview_accumulator)
+        self.add_video_observer(preview_accumulator)
+        return preview_accumulator
 
     def get_video(self, start_frame: Optional[int] = None, end_frame: Optional[int] = None, channel: int = 0) -> np.ndarray:
         """
         The frames are divided in three adjacent planes that must be separated
         """
         video = self.imaging_extractor.get_video(start_frame=start_frame, end_frame=end_frame, channel=channel)
-        return video[:,self.fov_boundaries[0]:self.fov_boundaries[1], :]
+        video = video[:,self.fov_boundaries[0]:self.fov_boundaries[1], :]
+        for video_observer in self.video_observers:
+            video_observer.update(video=video, start_frame=start_frame or 0)
+        return video
 
     def get_image_size(self) -> Tuple[int, int]:
         first_frame = self.get_frames(frame_idxs=0)
@@ -1,5 +1,9 @@
 import datetime
 from pathlib import Path
+from typing import Literal, Optional
+from hdmf.backends.hdf5 import H5DataIO
+from pynwb import NWBFile
+from pynwb.ophys import TwoPhotonSeries
 from neuroconv.datainterfaces.ophys.baseimagingextractorinterface import BaseImagingExtractorInterface
 from neuroconv.utils import FolderPathType
 from ..extractors.embargo2024_imaging_extractor import Embargo2024ImagingExtractor
@@ -69,4 +73,69 @@ class Embargo2024ImagingInterface(BaseImagingExtractorInterface):
         )
         metadata["NWBFile"].update(session_start_time=extracted_session_start_time)
 
-        return metadata
\ No newline at end of file
+        return metadata
+
+    def add_to_nwbfile(
+        self,
+        nwbfile: NWBFile,
+        metadata: Optional[dict] = None,
+        photon_series_type: Literal["TwoPhotonSeries", "OnePhotonSeries"] = "TwoPhotonSeries",
+        photon_series_index: int = 0,
+        parent_container: Literal["acquisition", "processing/ophys"] = "acquisition",
+        stub_test: bool = False,
+        stub_frames: int = 100,
+        preview_levels: Optional[list] = None,
+    ):
+        """Add the raw imaging data to the NWBFile.
+
+        Parameters
+        ----------
+        preview_levels : list of (int, int), optional
+            Pairs of (temporal_bin_size, spatial_downsampling_factor). For each pair, a preview of the video is
+            accumulated while the raw frames are streamed to disk, to be added with add_previews_to_nwbfile once the
+            file is written.
+        """
+        for temporal_bin_size, spatial_downsampling_factor in preview_levels or []:
+            self.imaging_extractor.add_preview_accumulator(
+                temporal_bin_size=temporal_bin_size, spatial_downsampling_factor=spatial_downsampling_factor
+            )
+        super().add_to_nwbfile(
+            nwbfile=nwbfile,
+            metadata=metadata,
+            photon_series_type=photon_series_type,
+            photon_series_index=photon_series_index,
+            parent_container=parent_container,
+            stub_test=stub_test,
+            stub_frames=stub_frames,
+        )
+
+    def add_previews_to_nwbfile(self, nwbfile: NWBFile, photon_series_name: str):
+        """Add the accumulated previews as TwoPhotonSeries next to the raw series they were computed from."""
+        raw_photon_series = nwbfile.acquisition[photon_series_name]
+        # The previews follow the clock of the raw series, its rate when it is regular, its timestamps otherwise
+        raw_timestamps = raw_photon_series.timestamps[:] if raw_photon_series.rate is None else None
+
+        for preview_accumulator in self.imaging_extractor.preview_accumulators:
+            temporal_bin_size = preview_accumulator.temporal_bin_size
+            spatial_downsampling_factor = preview_accumulator.spatial_downsampling_factor
+            # The raw frames are written as (frames, columns, rows), the preview follows the same layout
+            preview = preview_accumulator.get_preview().transpose(0, 2, 1)
+            if raw_timestamps is None:
+                timing_kwargs = dict(
+                    starting_time=raw_photon_series.starting_time, rate=raw_photon_series.rate / temporal_bin_size
+                )
+            else:
+                timing_kwargs = dict(timestamps=raw_timestamps[::temporal_bin_size][: len(preview)])
+            preview_photon_series = TwoPhotonSeries(
+                name=f"{photon_series_name}_preview_t{temporal_bin_size}_s{spatial_downsampling_factor}",
+                description=(
+                    f"Preview of {photon_series_name}: every {temporal_bin_size} frames are averaged and every "
+                    f"{spatial_downsampling_factor}x{spatial_downsampling_factor} pixel block is averaged. "
+                    f"Each preview frame starts at the time of the first frame of its bin."
+                ),
+                data=H5DataIO(preview, compression="gzip"),
+                imaging_plane=raw_photon_series.imaging_plane,
+                unit=raw_photon_series.unit,
+                **timing_kwargs,
+            )
+            nwbfile.add_acquisition(preview_photon_series)
@@ -0,0 +1,82 @@
+"""Helpers to store the timestamps shared by several series only once."""
+from typing import Optional
+
+import numpy as np
+from hdmf.data_utils import DataIO
+from pynwb import NWBFile, TimeSeries
+
+
+def get_regular_rate(timestamps, tolerance: float = 1e-3, rate: float = None) -> Optional[float]:
+    """
+    Return the rate of timestamps that all lie within 'tolerance' seconds of a regular grid, None otherwise.
+
+    Parameters
+    ----------
+    timestamps : array-like
+        The timestamps in seconds.
+    tolerance : float, default 1e-3
+        The maximum deviation in seconds between a timestamp and the regular grid.
+    rate : float, optional
+        The rate of the regular grid. Defaults to the mean rate of the timestamps.
+    """
+    timestamps = np.asarray(timestamps, dtype="float64")
+    if len(timestamps) < 2 or timestamps[-1] <= timestamps[0]:
+        return None
+
+    rate = rate or (len(timestamps) - 1) / (timestamps[-1] - timestamps[0])
+    regular_timestamps = timestamps[0] + np.arange(len(timestamps)) / rate
+    if np.max(np.abs(timestamps - regular_timestamps)) > tolerance:
+        return None
+    return float(rate)
+
+
+def _get_owned_timestamps(time_series: TimeSeries):
+    timestamps = time_series.fields.get("timestamps")
+    if timestamps is None or isinstance(timestamps, TimeSeries):
+        return None
+    return timestamps.data if isinstance(timestamps, DataIO) else timestamps
+
+
+def find_timestamps_source(nwbfile: NWBFile, timestamps) -> Optional[TimeSeries]:
+    """Return a TimeSeries of the NWBFile that already stores exactly these timestamps, if any."""
+    for neurodata_object in nwbfile.objects.values():
+        if not isinstance(neurodata_object, TimeSeries):
+            continue
+        owned_timestamps = _get_owned_timestamps(neurodata_object)
+        if owned_timestamps is None or len(owned_timestamps) != len(timestamps):
+            continue
+        if np.array_equal(owned_timestamps[:], timestamps):
+            return neurodata_object
+    return None
+
+
+def get_timing_kwargs(nwbfile: NWBFile, timestamps, rate: float = None) -> dict:
+    """
+    Return the timing arguments of a new TimeSeries with these timestamps.
+
+    When the rate of the clock is given, i.e. the clock was found regular, the series stores 'starting_time' and
+    'rate'. Otherwise, the new series links to the timestamps of a series of the NWBFile sharing the same clock, and
+    only stores its own timestamps if there is none.
+    """
+    if rate is not None:
+        return dict(starting_time=float(timestamps[0]), rate=rate)
+
+    timestamps_source = find_timestamps_source(nwbfile, timestamps)
+    return dict(timestamps=timestamps_source if timestamps_source is not None else timestamps)
+
+
+def link_duplicate_timestamps(time_series: list) -> None:
+    """Make every series link to the timestamps of the first series storing identical timestamps."""
+    timestamps_sources = []
+    for series in time_series:
+        owned_timestamps = _get_owned_timestamps(series)
+        if owned_timestamps is None:
+            continue
+        for timestamps_source in timestamps_sources:
+            source_timestamps = _get_owned_timestamps(timestamps_source)
+            if len(source_timestamps) == len(owned_timestamps) and np.array_equal(source_timestamps, owned_timestamps):
+                # The series are built by neuroconv with their own timestamps, so the link can only be set afterwards
+                series.fields["timestamps"] = timestamps_source
+                break
+        else:
+            timestamps_sources.append(series)